@@ -93,7 +93,9 @@ class Attention(nn.Module):
             queries = self.rope(queries)
             keys = self.rope(keys)
 
-        scores = (queries * self.scale) @ keys.transpose(0, 1, 3, 2)
+        # The attention scale is folded into wq at load time (see
+        # load_model), so no elementwise pass over the queries is needed.
+        scores = queries @ keys.transpose(0, 1, 3, 2)
         if mask is not None:
             scores += mask
         scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
@@ -362,6 +364,18 @@ def load_model(model_path):
     if quantization is not None:
         nn.QuantizedLinear.quantize_module(model, **quantization)
     model.update(tree_unflatten(list(weights.items())))
+    # Fold the attention scale into the query projection once, so the
+    # (queries * scale) elementwise multiply vanishes from every forward.
+    for layer in model.layers:
+        attn = layer.attention
+        if isinstance(attn.wq, nn.QuantizedLinear):
+            # The dequantized weight is scales * w + biases, so scaling
+            # both arrays scales the effective weight.
+            attn.wq.scales = attn.wq.scales * attn.scale
+            attn.wq.biases = attn.wq.biases * attn.scale
+        else:
+            attn.wq.weight = attn.wq.weight * attn.scale
+        attn.scale = 1.0
     tokenizer = SentencePieceProcessor(model_file=str(model_path / "tokenizer.model"))
     return model, tokenizer
 